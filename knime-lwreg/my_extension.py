@@ -1,18 +1,178 @@
+import collections
+import functools
 import logging
+import multiprocessing
+import sqlite3
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import closing
 from pathlib import Path
 
 import knime.extension as knext
 import lwreg
 import lwreg.standardization_lib
 import numpy as np
-import pandas as pd
+import pyarrow as pa
 from lwreg import utils
 
 LOGGER = logging.getLogger(__name__)
 
 # Importing LWReg: https://github.com/rinikerlab/lightweight-registration/
 
-lwreg.set_default_config(utils.defaultConfig())  # Configure LWReg with default settings
+
+@functools.cache
+def _ensure_default_config():
+    """Configures LWReg with default settings, once per process.
+
+    Deferred from import time so that loading the extension stays cheap.
+    """
+    lwreg.set_default_config(utils.defaultConfig())
+
+
+# Per-connection PRAGMAs applied to the SQLite connection before registering compounds.
+# The journal mode is stored in the database file and chosen when it is initialized.
+SQLITE_PRAGMAS = ("temp_store=MEMORY", "mmap_size=268435456")
+
+
+def _tune_sqlite_connection(connection):
+    """Applies SQLITE_PRAGMAS to an open SQLite connection.
+
+    Databases using write-ahead logging also get synchronous=NORMAL, so that a commit
+    no longer has to wait for an fsync. Without WAL this setting could corrupt the
+    database on power loss and is left alone.
+    """
+    for pragma in SQLITE_PRAGMAS:
+        connection.execute(f"PRAGMA {pragma}")
+    (journal_mode,) = connection.execute("PRAGMA journal_mode").fetchone()
+    if journal_mode.lower() == "wal":
+        connection.execute("PRAGMA synchronous=NORMAL")
+
+
+# Registry IDs are SQLite row IDs, handed to KNIME in the double columns the nodes have
+# always declared. Missing IDs are emitted as missing cells instead of NaN.
+ID_TYPE = pa.float64()
+
+# Outcomes reported in the Status column of the registration results. Rows carry an
+# int8 index into this tuple and the strings are only built with the output table.
+REGISTRATION_STATUSES = (
+    "Success",
+    *(f"Failed: {reason.name}" for reason in lwreg.RegistrationFailureReasons),
+    "Failed: OTHER",  # Unexpected exceptions, summarized in the log per type
+)
+STATUS_SUCCESS = 0
+STATUS_OTHER = len(REGISTRATION_STATUSES) - 1
+FAILURE_STATUSES = {
+    reason: status
+    for status, reason in enumerate(lwreg.RegistrationFailureReasons, start=1)
+}
+
+# Number of IDs passed to a single lwreg.retrieve call, below SQLite's historic default
+# limit of 999 bound parameters per statement.
+RETRIEVE_CHUNK_SIZE = 900
+
+# How often a registration is retried when another worker process holds the database
+# write lock for longer than SQLite's busy timeout.
+LOCKED_RETRIES = 3
+
+
+def _init_register_worker(db_config):
+    """Points lwreg in a registration worker process at the target database."""
+    _ensure_default_config()
+    lwreg.set_default_config(db_config)
+    _tune_sqlite_connection(utils._connect(db_config))
+
+
+def _register_smiles(smiles, db_config):
+    """Registers a single SMILES.
+
+    Returns a (compound ID, status code, error type, error message) tuple. The error
+    fields are None unless lwreg raised, in which case they carry the exception's type
+    name and message for the calling process to log. A registration that fails because
+    the database is locked is rolled back and retried up to LOCKED_RETRIES times. Lives
+    at module level so it can be shipped to registration worker processes.
+    """
+    try:
+        for attempt in range(LOCKED_RETRIES + 1):
+            try:
+                # Call the correct `register` function from lwreg.utils
+                compound_id = lwreg.register(config=db_config, smiles=smiles)
+                break
+            except sqlite3.OperationalError as e:
+                if "locked" not in str(e) or attempt == LOCKED_RETRIES:
+                    raise
+                utils._connect(db_config).rollback()
+                time.sleep(0.1 * (attempt + 1))
+    except Exception as e:
+        # Log records of worker processes never reach KNIME, so the error is handed
+        # back and summarized once per execution, see _log_registration_failures
+        return None, STATUS_OTHER, type(e).__name__, str(e)
+
+    # Check if the compound_id is a failure reason, i.e., an instance of RegistrationFailureReasons
+    if isinstance(compound_id, lwreg.RegistrationFailureReasons):
+        return None, FAILURE_STATUSES[compound_id], None, None
+    return compound_id, STATUS_SUCCESS, None, None
+
+
+def _check_canceled(exec_context):
+    """Raises if the user canceled the node's execution."""
+    if exec_context.is_canceled():
+        raise RuntimeError("Execution canceled.")
+
+
+def _expand_duplicates(smiles_data, unique_results):
+    """Maps the results of the unique SMILES back onto every input row.
+
+    Returns a float64 array of compound IDs (0 where registration failed) and an int8
+    array of status codes, both preallocated to the number of rows. Repeats of a
+    successfully registered SMILES are reported as duplicates, which is what lwreg
+    returns when the same structure is registered twice. Repeats of a failed SMILES get
+    the same failure.
+    """
+    n_compounds = len(smiles_data)
+    compound_ids = np.zeros(n_compounds, dtype=np.float64)
+    status_codes = np.empty(n_compounds, dtype=np.int8)
+    duplicate = FAILURE_STATUSES[lwreg.RegistrationFailureReasons.DUPLICATE]
+    reported = set()
+    for i, smiles in enumerate(smiles_data):
+        compound_id, status, _, _ = unique_results[smiles]
+        if status == STATUS_SUCCESS:
+            if smiles in reported:
+                status = duplicate
+            else:
+                compound_ids[i] = compound_id
+                reported.add(smiles)
+        status_codes[i] = status
+    return compound_ids, status_codes
+
+
+def _log_registration_failures(smiles_data, status_codes, unique_results):
+    """Logs one summary of how many compounds failed to register, per status.
+
+    Errors raised by lwreg are additionally counted per exception type, with the first
+    message of each type as an example. Like the statuses, they are counted per row.
+    """
+    error_counts = collections.Counter()
+    error_examples = {}
+    for smiles in smiles_data:
+        _, _, error_type, error_message = unique_results[smiles]
+        if error_type is not None:
+            error_counts[error_type] += 1
+            error_examples.setdefault(error_type, error_message)
+    for error_type, count in error_counts.items():
+        LOGGER.warning(
+            f"{count} compound(s) failed with {error_type}, "
+            f"e.g. {error_examples[error_type]}"
+        )
+
+    counts = np.bincount(status_codes, minlength=len(REGISTRATION_STATUSES))
+    failures = {
+        status: int(count)
+        for status, count in zip(REGISTRATION_STATUSES, counts)
+        if count and status != REGISTRATION_STATUSES[STATUS_SUCCESS]
+    }
+    if failures:
+        LOGGER.warning(f"Registration failures: {failures}")
+
 
 # Specifying our category: https://docs.knime.com/latest/pure_python_node_extensions_guide/index.html#_specifying_the_node_category
 # lwreg_category = knext.category(
@@ -68,6 +228,15 @@ class LWRegInitNode:
     db_canonical_orientation = knext.BoolParameter(
         "Canonical Orientation", description="Should the orientation be canonicalized?"
     )
+    db_wal_mode = knext.BoolParameter(
+        "Write-Ahead Logging",
+        description="Should the database use a write-ahead log? Makes registering many compounds much faster, "
+        "uncheck for the default rollback journal. WAL does not work for databases on network filesystems. "
+        "Committed data is kept in the -wal and -shm files next to the database until a checkpoint moves it into the database file, "
+        "so copy or move those files together with the database or uncheck this option.",
+        default_value=True,
+        since_version="0.2.0",
+    )
 
     def configure(self, configure_context):
         db_path = Path(self.db_path_input)
@@ -95,6 +264,8 @@ class LWRegInitNode:
             )
             return
 
+        _ensure_default_config()
+
         standardization = [self.db_standardization_operations]
         if self.db_canonical_orientation:
             standardization.append("canonicalize")
@@ -113,6 +284,16 @@ class LWRegInitNode:
         exec_context.flow_variables["lwreg_db_path"] = self.db_path_input
         exec_context.set_progress(0.0, "Initializing LWREG Database...")
         utils._initdb(config=init_custom_config, confirm=True)
+        if self.db_wal_mode:
+            # The journal mode is persisted in the database file, so it only needs to be set once
+            with closing(sqlite3.connect(self.db_path_input)) as connection:
+                (journal_mode,) = connection.execute(
+                    "PRAGMA journal_mode=WAL"
+                ).fetchone()
+            if journal_mode.lower() != "wal":
+                exec_context.set_warning(
+                    f"Could not enable write-ahead logging, the database uses journal mode '{journal_mode}'."
+                )
         exec_context.set_progress(1.0, "LWREG Database initialized successfully.")
 
 
@@ -151,6 +332,19 @@ class LWRegRegisterNode:
         port_index=0,  # Refers to the first input port (input table)
     )
 
+    # Number of processes used to standardize and register compounds in parallel
+    num_workers = knext.IntParameter(
+        label="Number of Workers",
+        description="Number of processes used to register compounds in parallel. "
+        "RDKit standardization and hashing run concurrently, writes to the database are serialized by SQLite "
+        "and retried if the database stays locked. With more than one worker, different SMILES of the same "
+        "structure are registered in whichever order the workers reach them, so which row gets the compound ID "
+        "and which is reported as a duplicate can vary between runs.",
+        default_value=1,
+        min_value=1,
+        since_version="0.2.0",
+    )
+
     def configure(self, configure_context, input_schema):
         output_schema = knext.Schema.from_columns(
             [
@@ -168,57 +362,95 @@ class LWRegRegisterNode:
     def execute(self, exec_context, input_table):
         exec_context.set_progress(0.0, "Registering compounds...")
 
+        _ensure_default_config()
+
         # Set the database path configuration for lwreg
-        lwreg.set_default_config({"dbname": self.db_path_input, "dbtype": "sqlite3"})
+        db_config = {"dbname": self.db_path_input, "dbtype": "sqlite3"}
+        lwreg.set_default_config(db_config)
 
-        # Convert input_table to pandas DataFrame for easier processing
-        input_df = input_table.to_pandas()
+        # lwreg keeps its connection open between calls, so the PRAGMAs set here apply
+        # to every registration in the loop below
+        _tune_sqlite_connection(utils._connect(db_config))
+
+        # Bind the config once instead of resolving lwreg's default for every compound
+        register_smiles = functools.partial(_register_smiles, db_config=db_config)
 
         # Extract SMILES column
-        if self.smiles_column not in input_df.columns:
+        if self.smiles_column not in input_table.schema.column_names:
             raise ValueError(
                 f"Column '{self.smiles_column}' not found in the input data."
             )
-        smiles_data = input_df[self.smiles_column]
-
-        # Create a list to store the registration results
-        registration_results = []
 
-        # Register each compound in the LWReg database
-        for idx, smiles in smiles_data.items():
-            try:
-                # Call the correct `register` function from lwreg.utils
-                compound_id = lwreg.register(smiles=smiles)
-
-                # Check if the compound_id is a failure reason, i.e., an instance of RegistrationFailureReasons
-                if isinstance(compound_id, lwreg.RegistrationFailureReasons):
-                    status = f"Failed: {compound_id.name}"  # Get the name of the failure reason (e.g., PARSE_FAILURE)
-                    registration_results.append(
-                        {
-                            "SMILES": smiles,
-                            "Compound ID": np.nan,  # np.nan does not throw KNIME off regarding data types, as None would.
-                            "Status": status,
-                        }
+        # Register each compound in the LWReg database. The input is streamed batch by
+        # batch and only the SMILES column of a batch is converted to Python objects.
+        # With worker processes, executor.map submits a batch right away, so it gets
+        # registered while the next batch is read. Each distinct SMILES is registered
+        # only once.
+        executor = (
+            ProcessPoolExecutor(
+                max_workers=self.num_workers,
+                # Workers must not inherit this process' open SQLite connection
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_register_worker,
+                initargs=(db_config,),
+            )
+            if self.num_workers > 1
+            else None
+        )
+        try:
+            smiles_data = []
+            unique_smiles = {}  # insertion-ordered set of the SMILES sent to lwreg
+            pending_batches = []
+            for batch in input_table.batches():
+                _check_canceled(exec_context)
+                smiles_batch = batch.to_pyarrow().column(self.smiles_column).to_pylist()
+                smiles_data.extend(smiles_batch)
+                new_smiles = [
+                    smiles
+                    for smiles in dict.fromkeys(smiles_batch)
+                    if smiles not in unique_smiles
+                ]
+                unique_smiles.update(dict.fromkeys(new_smiles))
+                if executor is not None:
+                    pending_batches.append(
+                        executor.map(register_smiles, new_smiles, chunksize=256)
                     )
                 else:
-                    status = "Success"
-                    registration_results.append(
-                        {"SMILES": smiles, "Compound ID": compound_id, "Status": status}
+                    pending_batches.append(
+                        [register_smiles(smiles) for smiles in new_smiles]
                     )
-
-            except Exception as e:
-                LOGGER.error(f"Failed to register compound '{smiles}': {e}")
-
-                # Handle unexpected exceptions
-                registration_results.append(
-                    {"SMILES": smiles, "Compound ID": np.nan, "Status": f"Failed: {e}"}
-                )
-
-        # Create a pandas DataFrame with the registration results
-        results_df = pd.DataFrame(registration_results)
+            results = []
+            for pending_batch in pending_batches:
+                _check_canceled(exec_context)
+                results.extend(pending_batch)
+            unique_results = dict(zip(unique_smiles, results))
+        except BaseException:
+            # Don't let the workers register the rest of the input after a failure
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
+            raise
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+        # Fill the result columns by position; N is known up front
+        ids_out, status_codes = _expand_duplicates(smiles_data, unique_results)
+        registered = status_codes == STATUS_SUCCESS
+        _log_registration_failures(smiles_data, status_codes, unique_results)
+
+        # Create an Arrow table directly from the result columns
+        results_table = pa.table(
+            {
+                "SMILES": pa.array(smiles_data, type=pa.string()),
+                "Compound ID": pa.array(ids_out, mask=~registered, type=ID_TYPE),
+                "Status": pa.array(REGISTRATION_STATUSES, type=pa.string()).take(
+                    status_codes
+                ),
+            }
+        )
 
         # Return the results as a KNIME table
-        return knext.Table.from_pandas(results_df)
+        return knext.Table.from_pyarrow(results_table)
 
 
 ########################
@@ -269,39 +501,56 @@ class LWRegQueryNode:
     def execute(self, exec_context):
         exec_context.set_progress(0.0, "Querying the LWReg database...")
 
+        _ensure_default_config()
+
         # Set the database path configuration for lwreg
-        lwreg.set_default_config({"dbname": self.db_path_input, "dbtype": "sqlite3"})
+        db_config = {"dbname": self.db_path_input, "dbtype": "sqlite3"}
+        lwreg.set_default_config(db_config)
 
         try:
             # Call the query function with the user-specified query input
-            query_results = lwreg.query(smiles=self.query_input)
+            query_results = lwreg.query(config=db_config, smiles=self.query_input)
+
+            # Nothing matched, return an empty table with the configured columns
+            if not query_results:
+                exec_context.set_progress(1.0, "Query completed, no matches found.")
+                empty_schema = pa.schema(
+                    [
+                        ("Query", pa.string()),
+                        ("Molregno", ID_TYPE),
+                        ("Conf_ID", ID_TYPE),
+                    ]
+                )
+                return knext.Table.from_pyarrow(empty_schema.empty_table())
 
             # Check if the result contains tuples (i.e., molregno and conf_id)
-            if query_results and isinstance(query_results[0], tuple):
+            if isinstance(query_results[0], tuple):
                 # Results are tuples, so we have Molregno and Conf_ID
-                results_df = pd.DataFrame(
-                    query_results, columns=["Molregno", "Conf_ID"]
-                )
-                # Convert Molregno and Conf_ID to float (double)
-                results_df["Molregno"] = results_df["Molregno"].astype(float)
-                results_df["Conf_ID"] = results_df["Conf_ID"].astype(float)
+                ids = np.asarray(query_results, dtype=np.float64)
+                molregnos = pa.array(ids[:, 0], type=ID_TYPE)
+                conf_ids = pa.array(ids[:, 1], type=ID_TYPE)
             else:
-                # Results are single values (Molregno only), add NaN for Conf_ID
-                results_df = pd.DataFrame(query_results, columns=["Molregno"])
-                # Convert Molregno to float (double)
-                results_df["Molregno"] = results_df["Molregno"].astype(float)
-                # Add Conf_ID as NaN since it's not available
-                results_df["Conf_ID"] = np.nan
-
-            # Add the "Query" column first
-            results_df.insert(
-                0, "Query", self.query_input
-            )  # Insert the query input as the first column
+                # Results are single values (Molregno only), Conf_ID is missing
+                molregnos = pa.array(
+                    np.asarray(query_results, dtype=np.float64), type=ID_TYPE
+                )
+                conf_ids = pa.nulls(len(molregnos), type=ID_TYPE)
+
+            # Build the Arrow table directly, with the "Query" column first
+            results_table = pa.table(
+                {
+                    "Query": pa.repeat(
+                        pa.scalar(self.query_input, type=pa.string()), len(molregnos)
+                    ),
+                    "Molregno": molregnos,
+                    "Conf_ID": conf_ids,
+                }
+            )
 
             exec_context.set_progress(1.0, "Query completed successfully.")
 
             # Return the results as a KNIME table
-            return knext.Table.from_pandas(results_df)
+            return knext.Table.from_pyarrow(results_table)
 
         except Exception as e:
             LOGGER.error(f"Query failed: {e}")
@@ -351,7 +600,7 @@ class LWRegRetrieveNode:
                 knext.Column(knext.double(), "Molregno"),  # Molregno will be a double
                 knext.Column(
                     knext.double(), "Conf_ID"
-                ),  # Conf_ID will be a double, optional but always present in schema
+                ),  # Conf_ID will also be a double, optional but always present in schema
                 knext.Column(
                     knext.string(), "Molecule Data"
                 ),  # Molecule Data will be a string
@@ -362,54 +611,95 @@ class LWRegRetrieveNode:
     def execute(self, exec_context, input_table):
         exec_context.set_progress(0.0, "Retrieving molecules from LWReg...")
 
-        # Set up the database connection using the provided path
-        lwreg.set_default_config({"dbname": self.db_path_input, "dbtype": "sqlite3"})
-
-        # Convert input_table to pandas DataFrame
-        input_df = input_table.to_pandas()
+        _ensure_default_config()
 
-        # Prepare the IDs for retrieval
-        ids = []
+        # Set up the database connection using the provided path
+        db_config = {"dbname": self.db_path_input, "dbtype": "sqlite3"}
+        lwreg.set_default_config(db_config)
+
+        # Convert only the ID columns of input_table to a pandas DataFrame
+        input_arrow = input_table.to_pyarrow()
+        id_columns = [
+            column
+            for column in ("Molregno", "Conf_ID")
+            if column in input_arrow.column_names
+        ]
+        input_df = input_arrow.select(id_columns).to_pandas(split_blocks=True)
+
+        # Prepare the IDs for retrieval. Missing Molregnos arrive as NaN and would turn
+        # into garbage IDs when cast to int64, so they are rejected up front.
+        n_missing = int(input_df["Molregno"].isna().sum())
+        if n_missing:
+            raise ValueError(
+                f"Column 'Molregno' contains {n_missing} missing value(s)."
+            )
+        molregnos = input_df["Molregno"].to_numpy(dtype=np.int64)
         if "Conf_ID" in input_df.columns:
-            # Extract Molregno and Conf_ID from DataFrame, flattening tuples
+            # Extract Molregno and Conf_ID column-wise, pairing them only where a Conf_ID is set
+            conf_ids = input_df["Conf_ID"].to_numpy()
+            has_conf_id = input_df["Conf_ID"].notna().to_numpy()
             ids = [
-                (
-                    (int(row["Molregno"]), int(row["Conf_ID"]))
-                    if not pd.isna(row["Conf_ID"])
-                    else int(row["Molregno"])
-                )
-                for index, row in input_df.iterrows()
+                (int(molregno), int(conf_id)) if has_conf else int(molregno)
+                for molregno, conf_id, has_conf in zip(molregnos, conf_ids, has_conf_id)
             ]
         else:
             # Only Molregno is provided
-            ids = input_df["Molregno"].astype(int).tolist()
+            ids = molregnos.tolist()
 
-        # Call lwreg.retrieve with the list of IDs
-        try:
-            retrieval_results = lwreg.retrieve(
-                config=None, ids=ids, as_submitted=self.as_submitted
-            )
+        # lwreg.retrieve returns a dict, so repeated IDs collapse into one row. Dropping
+        # them before chunking keeps that independent of where they sit in the input.
+        ids = list(dict.fromkeys(ids))
 
-            # Process retrieval results into a DataFrame
-            results = []
-            for key, (data, fmt) in retrieval_results.items():
-                if isinstance(key, tuple):
-                    molregno, conf_id = key
-                else:
-                    molregno = key
-                    conf_id = np.nan  # If Conf_ID is not available
-
-                results.append(
-                    {"Molregno": molregno, "Conf_ID": conf_id, "Molecule Data": data}
-                )
+        # Call lwreg.retrieve with the list of IDs, one chunk at a time
+        try:
+            molregnos = []
+            conf_ids = []
+            molecule_data = []
+
+            # lwreg reuses its cached connection for db_config. Reading every chunk in
+            # one transaction gives all of them the same snapshot of the database. A
+            # transaction that was already open is left to whoever opened it.
+            connection = utils._connect(db_config)
+            began = not connection.in_transaction
+            if began:
+                connection.execute("BEGIN")
+            try:
+                for start in range(0, len(ids), RETRIEVE_CHUNK_SIZE):
+                    retrieval_results = lwreg.retrieve(
+                        config=db_config,
+                        ids=ids[start : start + RETRIEVE_CHUNK_SIZE],
+                        as_submitted=self.as_submitted,
+                    )
 
-            # Convert results to a DataFrame
-            results_df = pd.DataFrame(results)
+                    # Process retrieval results into columns
+                    for key, (data, fmt) in retrieval_results.items():
+                        if isinstance(key, tuple):
+                            molregno, conf_id = key
+                        else:
+                            molregno = key
+                            conf_id = None  # If Conf_ID is not available
+
+                        molregnos.append(molregno)
+                        conf_ids.append(conf_id)
+                        molecule_data.append(data)
+            finally:
+                # Only a read snapshot, there is nothing to commit
+                if began:
+                    connection.rollback()
+
+            # Convert results to an Arrow table
+            results_table = pa.table(
+                {
+                    "Molregno": pa.array(molregnos, type=ID_TYPE),
+                    "Conf_ID": pa.array(conf_ids, type=ID_TYPE),
+                    "Molecule Data": pa.array(molecule_data, type=pa.string()),
+                }
+            )
 
             exec_context.set_progress(1.0, "Molecule retrieval completed.")
 
             # Return the results as a KNIME table
-            return knext.Table.from_pandas(results_df)
+            return knext.Table.from_pyarrow(results_table)
 
         except Exception as e:
             LOGGER.error(f"Retrieval failed: {e}")